@@ -1,17 +1,60 @@
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import time
+import random
 import os
+import socket
+import functools
+import traceback
+from dataclasses import dataclass, field
 import boto3
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from collections import defaultdict
 
-# Setup logging
-logging.basicConfig(level=logging.DEBUG)
+# Prefer orjson for encoding/decoding, falling back to the stdlib when the layer doesn't ship it
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+
+    json_dumps_bytes = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    # Match orjson's compact output so payloads don't carry whitespace
+    json_dumps = functools.partial(json.dumps, separators=(',', ':'))
+
+    def json_dumps_bytes(obj):
+        return json_dumps(obj).encode()
+
+    json_loads = json.loads
+
+# Setup logging, honouring the function's configured log level and defaulting to INFO
+LOG_LEVEL = logging.getLevelName(
+    (os.environ.get('AWS_LAMBDA_LOG_LEVEL') or os.environ.get('LOG_LEVEL') or 'INFO').upper())
+if not isinstance(LOG_LEVEL, int):
+    LOG_LEVEL = logging.INFO
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger()
+# The Lambda runtime installs its own handler, which makes basicConfig a no-op there
+logger.setLevel(LOG_LEVEL)
 
 # Get environment variables
 PASSWORD = os.environ.get('SHOPIFY_PASSWORD')
 SHOP_NAME = os.environ.get('SHOPIFY_SHOP_NAME', 'roof-top-shop')
+# Include tracebacks in API Gateway error responses; only meant for debugging
+DEBUG = os.environ.get('DEBUG', '').strip().lower() in ('1', 'true')
+
+# Name of our own warehouse as it appears in the availability_location metafield
+ROOFTOP = "Rooftopshop Magazijn"
+
+# Prefixes that turn numeric Shopify ids into GraphQL global ids
+_ORDER_GID_PREFIX = "gid://shopify/Order/"
+_GID_PREFIX = "gid://shopify/FulfillmentOrder/"
 
 # GraphQL API endpoint
 url = f'https://{SHOP_NAME}.myshopify.com/admin/api/2024-10/graphql.json'
@@ -20,81 +63,305 @@ headers = {
     "X-Shopify-Access-Token": PASSWORD
 }
 
-def send_request_with_retry(query, max_retries=3, delay=2):
+# GraphQL documents, kept constant so only the variables change between calls
+FO_DETAILS_QUERY = """
+query fulfillmentOrderLineItems($id: ID!, $first: Int!, $after: String) {
+  fulfillmentOrder(id: $id) {
+    id
+    status
+    lineItems(first: $first, after: $after) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      edges {
+        node {
+          id
+          lineItem {
+            quantity
+            id
+            variant {
+              metafields(first: 3, keys: [
+                "fulfillment_system.availability_location",
+                "fulfillment_system.length_transport",
+                "fulfillment_system.daktrim_koppelstukje"
+              ]) {
+                nodes {
+                  key
+                  value
+                }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+SPLIT_MUTATION = """
+mutation splitFulfillmentOrder($splits: [FulfillmentOrderSplitInput!]!) {
+  fulfillmentOrderSplit(fulfillmentOrderSplits: $splits) {
+    fulfillmentOrderSplits {
+      fulfillmentOrder {
+        id
+        status
+      }
+      remainingFulfillmentOrder {
+        id
+        status
+      }
+    }
+    userErrors {
+      field
+      message
+    }
+  }
+}
+"""
+
+TAGS_ADD_MUTATION = """
+mutation addTags($id: ID!, $tags: [String!]!) {
+  tagsAdd(id: $id, tags: $tags) {
+    node {
+      id
+    }
+    userErrors {
+      message
+    }
+  }
+}
+"""
+
+# Disable Nagle so small GraphQL requests aren't held back waiting for an ACK.
+# urllib3 defaults to this today; pinning it keeps it that way. (httpcore always sets it.)
+SOCKET_OPTIONS = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+
+class ShopifyAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = SOCKET_OPTIONS
+        return super().init_poolmanager(*args, **kwargs)
+
+# Shared session so warm Lambda containers reuse the TLS connection to Shopify
+# (retries are handled in send_request_with_retry, so urllib3 must not retry on its own)
+SESSION = requests.Session()
+SESSION.mount('https://', ShopifyAdapter(pool_connections=1, pool_maxsize=4, max_retries=Retry(total=0)))
+SESSION.headers.update(headers)
+
+# Prefer an HTTP/2 client so concurrent calls are multiplexed over a single connection.
+# Without httpx (or its h2 extra) in the layer we fall back to the requests session above.
+try:
+    import httpx
+    # httpx rejects None header values, e.g. when SHOPIFY_PASSWORD isn't set
+    CLIENT = httpx.Client(http2=True, timeout=10,
+                          headers={name: value for name, value in headers.items() if value is not None})
+    REQUEST_ERRORS = (requests.exceptions.RequestException, httpx.HTTPError)
+except ImportError:
+    CLIENT = None
+    REQUEST_ERRORS = (requests.exceptions.RequestException,)
+
+def post_graphql(body):
+    """POST an encoded GraphQL request body to the Shopify Admin API."""
+    if CLIENT is not None:
+        return CLIENT.post(url, content=body)
+    return SESSION.post(url, data=body, timeout=10)
+
+# Worker threads for Shopify calls that don't depend on each other; sized to the session's pool
+EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Line items requested per page of the fulfillment order query. `first` only caps the page,
+# so small orders get the same response either way and large ones need fewer round trips.
+LINE_ITEMS_PAGE_SIZE = 50
+
+# Fraction of the REST call limit bucket in use before we start backing off
+CALL_LIMIT_THRESHOLD = 0.8
+
+# Upper bound for a single rate limit or retry sleep
+MAX_RETRY_DELAY = 30
+
+def wait_for_rate_limit(response, response_json):
+    """
+    Sleep only when Shopify reports that the rate limit bucket is close to empty,
+    based on the call limit header and the GraphQL query cost extension.
+    """
+    call_limit = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+    if call_limit:
+        try:
+            used, maximum = (int(part) for part in call_limit.split('/'))
+            if used / maximum >= CALL_LIMIT_THRESHOLD:
+                logger.info(f"API call limit at {call_limit} - backing off")
+                time.sleep(0.5)
+        except (ValueError, ZeroDivisionError):
+            logger.warning(f"Could not parse API call limit header: {call_limit}")
+    
+    cost = (response_json.get('extensions') or {}).get('cost') or {}
+    throttle_status = cost.get('throttleStatus')
+    if throttle_status:
+        requested = cost.get('requestedQueryCost') or 0
+        available = throttle_status.get('currentlyAvailable', 0)
+        restore_rate = throttle_status.get('restoreRate') or 1
+        # Leave room for the next query of a similar cost before continuing
+        if available < requested * 2:
+            wait = min(MAX_RETRY_DELAY, (requested * 2 - available) / restore_rate)
+            logger.info(f"Query cost bucket at {available}/{throttle_status.get('maximumAvailable')} - waiting {wait:.2f}s")
+            time.sleep(wait)
+
+def is_throttled(response_json):
+    """Check whether a GraphQL response was rejected because the cost bucket is empty."""
+    errors = response_json.get('errors')
+    if not isinstance(errors, list):
+        return False
+    return any((error.get('extensions') or {}).get('code') == 'THROTTLED'
+               for error in errors if isinstance(error, dict))
+
+def get_retry_delay(attempt, delay, response=None, response_json=None):
+    """
+    Exponential backoff with jitter, capped at MAX_RETRY_DELAY. Shopify's own hints
+    (Retry-After on 429/503, restore rate on throttled GraphQL queries) take precedence.
+    """
+    if response is not None and response.status_code in (429, 503):
+        try:
+            retry_after = float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            retry_after = 0
+        if retry_after > 0:
+            return min(MAX_RETRY_DELAY, retry_after)
+    
+    if response_json:
+        cost = (response_json.get('extensions') or {}).get('cost') or {}
+        throttle_status = cost.get('throttleStatus') or {}
+        restore_rate = throttle_status.get('restoreRate')
+        if restore_rate:
+            missing = (cost.get('requestedQueryCost') or 0) - throttle_status.get('currentlyAvailable', 0)
+            if missing > 0:
+                return min(MAX_RETRY_DELAY, missing / restore_rate)
+    
+    return min(MAX_RETRY_DELAY, (2 ** attempt) * delay * (1 + random.random() * 0.5))
+
+def send_request_with_retry(query, max_retries=3, delay=2, max_total_delay=30):
     """Send a request with retry logic."""
+    total_delay = 0
     for attempt in range(max_retries):
         try:
-            logger.info(f"Sending GraphQL request (attempt {attempt + 1}/{max_retries})")
-            response = requests.post(url, json=query, headers=headers, timeout=10)
+            logger.debug("Sending GraphQL request (attempt %d/%d)", attempt + 1, max_retries)
+            response = post_graphql(json_dumps_bytes(query))
             
             if response.status_code == 200:
-                response_json = response.json()
-                # Check for GraphQL errors inside a 200 response
-                if 'errors' in response_json:
-                    logger.warning(f"GraphQL errors in response: {json.dumps(response_json['errors'])}")
-                
-                # Add a small delay even after successful requests to avoid overloading the API
-                time.sleep(0.5)
-                return response_json
+                response_json = json_loads(response.content)
+                if is_throttled(response_json):
+                    logger.warning(f"Attempt {attempt + 1} was throttled by Shopify")
+                    wait = get_retry_delay(attempt, delay, response, response_json)
+                else:
+                    # Check for GraphQL errors inside a 200 response
+                    if 'errors' in response_json:
+                        logger.warning(f"GraphQL errors in response: {json_dumps(response_json['errors'])}")
+                    
+                    # Only slow down when Shopify signals we are close to being throttled
+                    wait_for_rate_limit(response, response_json)
+                    return response_json
             else:
                 logger.warning(f"Attempt {attempt + 1} failed with status {response.status_code}: {response.text}")
-                if attempt < max_retries - 1:  # Don't sleep on the last attempt
-                    time.sleep(delay * (attempt + 1))  # Exponential backoff
-        except requests.exceptions.RequestException as e:
+                wait = get_retry_delay(attempt, delay, response)
+        # ValueError covers a 200 with a body that isn't JSON (e.g. a gateway error page)
+        except REQUEST_ERRORS + (ValueError,) as e:
             logger.warning(f"Attempt {attempt + 1} failed with exception: {str(e)}")
-            if attempt < max_retries - 1:
-                time.sleep(delay * (attempt + 1))
+            wait = get_retry_delay(attempt, delay)
+        
+        if attempt == max_retries - 1:  # Don't sleep on the last attempt
+            break
+        if total_delay + wait > max_total_delay:
+            logger.error(f"Giving up: retrying would exceed the {max_total_delay}s retry budget")
+            break
+        total_delay += wait
+        time.sleep(wait)
     
     logger.error("All retries failed.")
     return None
 
 
+@dataclass(slots=True)
+class LineItem:
+    """A fulfillment order line item with the metafields that drive the decision tree."""
+    id: str  # Fulfillment order line item ID, used for splitting
+    line_item_id: str
+    quantity: int
+    available_locations: list
+    is_length_transport: bool
+    is_daktrim_koppelstukje: bool
+    loc_set: frozenset = field(init=False)
+    # Location an external item is split to, set by categorize_items
+    target_location: str = field(default=None, init=False)
+
+    def __post_init__(self):
+        self.loc_set = frozenset(self.available_locations)
+
+@dataclass(slots=True)
+class Summary:
+    """Order-level facts derived from the categorized items."""
+    has_length_items: bool
+    has_daktrim_koppelstukje_items: bool
+    all_items_at_rooftopshop: bool
+    all_non_length_at_rooftopshop: bool
+    external_locations: list
+
+@dataclass(slots=True)
+class Categories:
+    """Line items of a fulfillment order, grouped by the decision tree categories."""
+    length_rooftopshop: list = field(default_factory=list)      # Length products at Rooftopshop
+    non_length_rooftopshop: list = field(default_factory=list)  # Non-length products at Rooftopshop
+    length_external: list = field(default_factory=list)         # Length products at external locations
+    non_length_external: list = field(default_factory=list)     # Non-length products at external locations
+    daktrim_koppelstukje_rooftopshop: list = field(default_factory=list)  # Daktrim koppelstukje products at Rooftopshop
+    summary: Summary = None
+
+@functools.lru_cache(maxsize=256)
+def parse_locations(value):
+    """
+    Parse an availability_location metafield value into a tuple of location names.
+    The same few location lists repeat across line items, so each distinct value is decoded once.
+    """
+    locations = json_loads(value)
+    # Ensure we always end up with a sequence of locations
+    if not isinstance(locations, list):
+        return (locations,) if locations else ()
+    return tuple(locations)
+
 def get_fulfillment_order_details(fulfillment_order_id):
     """
     Get the fulfillment order details including line items, available locations,
     whether items are length-transport items, and daktrim_koppelstukje flags.
     """
-    query = {
-        "query": """
-        query {
-          fulfillmentOrder(id: "%s") {
-            id
-            status
-            lineItems(first: 50) {
-              edges {
-                node {
-                  id
-                  lineItem {
-                    quantity
-                    id
-                    name
-                    sku
-                    variant {
-                      metafields(namespace: "fulfillment_system", first: 10) {
-                        nodes {
-                          key
-                          value
-                        }
-                      }
-                    }
-                  }
-                }
-              }
-            }
-          }
-        }
-        """ % fulfillment_order_id
-    }
     
     logger.info(f"Fetching fulfillment order details for {fulfillment_order_id}")
-    result = send_request_with_retry(query)
     
-    if not result or 'errors' in result or not result.get('data', {}).get('fulfillmentOrder'):
-        if 'errors' in result:
-            logger.error(f"GraphQL errors: {json.dumps(result['errors'])}")
-        else:
-            logger.error("Failed to get fulfillment order details")
-        return None
+    # Page through the line items, following the cursor until Shopify reports no more pages
+    edges = []
+    after = None
+    while True:
+        result = send_request_with_retry({
+            "query": FO_DETAILS_QUERY,
+            "variables": {
+                "id": fulfillment_order_id,
+                "first": LINE_ITEMS_PAGE_SIZE,
+                "after": after
+            }
+        })
+        
+        if not result or 'errors' in result or not result.get('data', {}).get('fulfillmentOrder'):
+            if result and 'errors' in result:
+                logger.error(f"GraphQL errors: {json_dumps(result['errors'])}")
+            else:
+                logger.error("Failed to get fulfillment order details")
+            return None
+        
+        line_items = result['data']['fulfillmentOrder']['lineItems']
+        edges.extend(line_items['edges'])
+        
+        if not line_items['pageInfo']['hasNextPage']:
+            break
+        after = line_items['pageInfo']['endCursor']
+        logger.info(f"Fetching next page of line items for {fulfillment_order_id}")
     
     # Parse the response to extract line items with their details
     parsed_data = {
@@ -103,8 +370,6 @@ def get_fulfillment_order_details(fulfillment_order_id):
         'line_items': []
     }
     
-    edges = result['data']['fulfillmentOrder']['lineItems']['edges']
-    
     if not edges:
         logger.info(f"Fulfillment order {fulfillment_order_id} has no line items")
         return parsed_data
@@ -129,10 +394,7 @@ def get_fulfillment_order_details(fulfillment_order_id):
                 
                 if key == 'availability_location':
                     try:
-                        # Ensure available_locations is a list
-                        available_locations = json.loads(value)
-                        if not isinstance(available_locations, list):
-                            available_locations = [available_locations] if available_locations else []
+                        available_locations = list(parse_locations(value))
                     except Exception as e:
                         logger.warning(f"Failed to parse locations from metafield: {str(e)}")
                         available_locations = []
@@ -151,16 +413,14 @@ def get_fulfillment_order_details(fulfillment_order_id):
                         logger.warning(f"Failed to parse daktrim_koppelstukje flag: {str(e)}")
                         is_daktrim_koppelstukje = False
         
-        parsed_data['line_items'].append({
-            'fulfillment_order_line_item_id': node['id'],
-            'line_item_id': line_item['id'],
-            'name': line_item['name'],
-            'sku': line_item.get('sku', ''),
-            'quantity': line_item['quantity'],
-            'available_locations': available_locations,
-            'is_length_transport': is_length_transport,
-            'is_daktrim_koppelstukje': is_daktrim_koppelstukje
-        })
+        parsed_data['line_items'].append(LineItem(
+            id=node['id'],
+            line_item_id=line_item['id'],
+            quantity=line_item['quantity'],
+            available_locations=available_locations,
+            is_length_transport=is_length_transport,
+            is_daktrim_koppelstukje=is_daktrim_koppelstukje
+        ))
     
     return parsed_data
 
@@ -174,92 +434,63 @@ def categorize_items(order_details):
     - Daktrim koppelstukje products at Rooftopshop Magazijn
     """
     # Initialize categories
-    categories = {
-        "length_rooftopshop": [],      # Length products at Rooftopshop
-        "non_length_rooftopshop": [],  # Non-length products at Rooftopshop
-        "length_external": [],         # Length products at external locations
-        "non_length_external": [],     # Non-length products at external locations
-        "daktrim_koppelstukje_rooftopshop": []  # Daktrim koppelstukje products at Rooftopshop
-    }
+    categories = Categories()
     
     # External locations tracking
     external_locations = set()
     
     # Group items into categories
-    for item in order_details.get('line_items', []):
-        # Retrieve available locations - ensure it's a list
-        available_locations = item.get('available_locations', [])
-        if not isinstance(available_locations, list):
-            available_locations = [available_locations] if available_locations else []
-        
+    # The categories hold references to the parsed LineItem objects rather than copies
+    for item in order_details['line_items']:
         # Check if Rooftopshop is in available locations
-        is_at_rooftopshop = "Rooftopshop Magazijn" in available_locations
-        
-        # Track external locations if applicable
-        if not is_at_rooftopshop and available_locations:
-            external_locations.update(loc for loc in available_locations if loc != "Rooftopshop Magazijn")
-        
-        # Safely extract flags - ensure they're booleans
-        is_length_transport = item.get('is_length_transport', False)
-        if not isinstance(is_length_transport, bool):
-            # Try to convert to boolean if it's a string
-            if isinstance(is_length_transport, str):
-                is_length_transport = is_length_transport.lower() == 'true'
-            else:
-                is_length_transport = bool(is_length_transport)
-                
-        is_daktrim_koppelstukje = item.get('is_daktrim_koppelstukje', False)
-        if not isinstance(is_daktrim_koppelstukje, bool):
-            # Try to convert to boolean if it's a string
-            if isinstance(is_daktrim_koppelstukje, str):
-                is_daktrim_koppelstukje = is_daktrim_koppelstukje.lower() == 'true'
-            else:
-                is_daktrim_koppelstukje = bool(is_daktrim_koppelstukje)
-        
-        # Prepare item details for categorization
-        item_details = {
-            "id": item.get('fulfillment_order_line_item_id'),
-            "quantity": item.get('quantity', 0),
-            "locations": available_locations,
-            "is_length_transport": is_length_transport,
-            "is_daktrim_koppelstukje": is_daktrim_koppelstukje
-        }
+        is_at_rooftopshop = ROOFTOP in item.loc_set
+        
+        # Track external locations if applicable (Rooftopshop isn't among them here)
+        if not is_at_rooftopshop:
+            external_locations |= item.loc_set
+            # Split external items to their first location; items without any locations stay put
+            if item.available_locations:
+                item.target_location = item.available_locations[0]
         
         # Special case: Daktrim koppelstukje at Rooftopshop Magazijn
-        if is_daktrim_koppelstukje and is_at_rooftopshop:
-            categories["daktrim_koppelstukje_rooftopshop"].append(item_details)
+        if item.is_daktrim_koppelstukje and is_at_rooftopshop:
+            categories.daktrim_koppelstukje_rooftopshop.append(item)
             continue
             
         # Categorize based on type and location
-        if is_length_transport:
+        if item.is_length_transport:
             if is_at_rooftopshop:
-                categories["length_rooftopshop"].append(item_details)
+                categories.length_rooftopshop.append(item)
             else:
-                categories["length_external"].append(item_details)
+                categories.length_external.append(item)
         else:  # Non-length items
             if is_at_rooftopshop:
-                categories["non_length_rooftopshop"].append(item_details)
+                categories.non_length_rooftopshop.append(item)
             else:
-                categories["non_length_external"].append(item_details)
+                categories.non_length_external.append(item)
     
     # Add summary info
-    categories["summary"] = {
-        "has_length_items": len(categories["length_rooftopshop"]) + len(categories["length_external"]) > 0,
-        "has_daktrim_koppelstukje_items": len(categories["daktrim_koppelstukje_rooftopshop"]) > 0,
-        "all_items_at_rooftopshop": len(categories["length_external"]) + len(categories["non_length_external"]) == 0,
-        "all_non_length_at_rooftopshop": len(categories["non_length_external"]) == 0,
-        "external_locations": list(external_locations)
-    }
+    categories.summary = Summary(
+        has_length_items=len(categories.length_rooftopshop) + len(categories.length_external) > 0,
+        has_daktrim_koppelstukje_items=len(categories.daktrim_koppelstukje_rooftopshop) > 0,
+        all_items_at_rooftopshop=len(categories.length_external) + len(categories.non_length_external) == 0,
+        all_non_length_at_rooftopshop=len(categories.non_length_external) == 0,
+        external_locations=list(external_locations)
+    )
     
     # Log categorization
     if 'logger' in globals():
-        logger.info("Item categorization summary:")
-        logger.info(f"Length items at Rooftopshop: {len(categories['length_rooftopshop'])}")
-        logger.info(f"Non-length items at Rooftopshop: {len(categories['non_length_rooftopshop'])}")
-        logger.info(f"Length items at external locations: {len(categories['length_external'])}")
-        logger.info(f"Non-length items at external locations: {len(categories['non_length_external'])}")
-        logger.info(f"Daktrim koppelstukje items at Rooftopshop: {len(categories['daktrim_koppelstukje_rooftopshop'])}")
-        logger.info(f"External locations: {categories['summary']['external_locations']}")
+        logger.info(
+            "Item categorization summary: length at Rooftopshop=%d, non-length at Rooftopshop=%d, "
+            "length external=%d, non-length external=%d, daktrim koppelstukje at Rooftopshop=%d, "
+            "external locations=%s",
+            len(categories.length_rooftopshop),
+            len(categories.non_length_rooftopshop),
+            len(categories.length_external),
+            len(categories.non_length_external),
+            len(categories.daktrim_koppelstukje_rooftopshop),
+            categories.summary.external_locations
+        )
     
     return categories
 
@@ -268,79 +499,32 @@ def group_by_external_location(items):
     Group items by their external locations for splitting.
     Returns a dictionary with location name as key and items as values.
     """
-    location_groups = {}
+    location_groups = defaultdict(list)
     
     for item in items:
-        # For items with multiple locations, assign to first non-Rooftopshop location
-        assigned = False
-        if item.get('locations'):
-            for location in item['locations']:
-                if location != "Rooftopshop Magazijn":
-                    if location not in location_groups:
-                        location_groups[location] = []
-                    
-                    # Only include id and quantity fields for the API
-                    location_groups[location].append({
-                        "id": item['id'],
-                        "quantity": item['quantity']
-                    })
-                    assigned = True
-                    break
-        
-        # If no valid location found, add to "unknown" group
-        if not assigned:
-            if "unknown" not in location_groups:
-                location_groups["unknown"] = []
-            
-            # Only include id and quantity fields for the API
-            location_groups["unknown"].append({
-                "id": item['id'],
-                "quantity": item['quantity']
-            })
+        # Assign to the first non-Rooftopshop location, or the "unknown" group if there is none
+        location = next((loc for loc in item.available_locations if loc != ROOFTOP), "unknown")
+        # Only include id and quantity fields for the API
+        location_groups[location].append({"id": item.id, "quantity": item.quantity})
     
-    return location_groups
+    return dict(location_groups)
 
-def split_fulfillment_order(fulfillment_order_id, items_to_split):
+def split_fulfillment_order(splits_list):
     """
-    Split the fulfillment order to separate the specified items.
-    Returns the ID of the new fulfillment order.
+    Split fulfillment orders with a single fulfillmentOrderSplit mutation.
+    Each entry of splits_list holds a fulfillmentOrderId and the fulfillmentOrderLineItems
+    to move out of it. Returns a list with the (id, status) of the new fulfillment order
+    for every entry, in the same order, or None and an error message.
     """
     # Use variables approach for GraphQL
     split_mutation = {
-        "query": """
-        mutation splitFulfillmentOrder($fulfillmentOrderId: ID!, $lineItems: [FulfillmentOrderLineItemInput!]!) {
-          fulfillmentOrderSplit(
-            fulfillmentOrderSplits: [
-              {
-                fulfillmentOrderId: $fulfillmentOrderId,
-                fulfillmentOrderLineItems: $lineItems
-              }
-            ]
-          ) {
-            fulfillmentOrderSplits {
-              fulfillmentOrder {
-                id
-                status
-              }
-              remainingFulfillmentOrder {
-                id
-                status
-              }
-            }
-            userErrors {
-              field
-              message
-            }
-          }
-        }
-        """,
+        "query": SPLIT_MUTATION,
         "variables": {
-            "fulfillmentOrderId": fulfillment_order_id,
-            "lineItems": items_to_split
+            "splits": splits_list
         }
     }
     
-    logger.info(f"Executing split mutation for {len(items_to_split)} items")
+    logger.info(f"Executing split mutation for {len(splits_list)} splits")
     split_data = send_request_with_retry(split_mutation)
     
     # Check response and handle errors
@@ -349,7 +533,7 @@ def split_fulfillment_order(fulfillment_order_id, items_to_split):
         return None, "No response from Shopify API"
     
     if 'errors' in split_data:
-        error_msg = json.dumps(split_data['errors'])
+        error_msg = json_dumps(split_data['errors'])
         logger.error(f"GraphQL errors: {error_msg}")
         return None, f"GraphQL errors from Shopify API: {error_msg}"
     
@@ -364,77 +548,74 @@ def split_fulfillment_order(fulfillment_order_id, items_to_split):
         logger.error("Could not check for user errors in response")
     
     if user_errors:
-        error_msg = json.dumps(user_errors)
+        error_msg = json_dumps(user_errors)
         logger.error(f"User errors: {error_msg}")
         return None, f"User errors from Shopify API: {error_msg}"
     
     # Extract new fulfillment order details
     try:
         splits = split_data['data']['fulfillmentOrderSplit']['fulfillmentOrderSplits']
-        if splits:
+        if not splits:
+            logger.warning("No splits returned from API")
+            return None, "No splits returned from API"
+        
+        if len(splits) != len(splits_list):
+            logger.warning(f"Requested {len(splits_list)} splits but API returned {len(splits)}")
+            return None, f"Requested {len(splits_list)} splits but API returned {len(splits)}"
+        
+        new_orders = []
+        for split in splits:
             # Extract the new fulfillment order ID
             new_id = None
-            if splits[0].get('remainingFulfillmentOrder', {}).get('id'):
-                new_id = splits[0]['remainingFulfillmentOrder']['id']
-                new_status = splits[0]['remainingFulfillmentOrder'].get('status', 'UNKNOWN')
-            elif splits[0].get('fulfillmentOrder', {}).get('id'):
-                new_id = splits[0]['fulfillmentOrder']['id']
-                new_status = splits[0]['fulfillmentOrder'].get('status', 'UNKNOWN')
+            if (split.get('remainingFulfillmentOrder') or {}).get('id'):
+                new_id = split['remainingFulfillmentOrder']['id']
+                new_status = split['remainingFulfillmentOrder'].get('status', 'UNKNOWN')
+            elif (split.get('fulfillmentOrder') or {}).get('id'):
+                new_id = split['fulfillmentOrder']['id']
+                new_status = split['fulfillmentOrder'].get('status', 'UNKNOWN')
             
-            if new_id:
-                logger.info(f"Successfully split items, new fulfillment order ID: {new_id}")
-                return new_id, new_status
-            else:
+            if not new_id:
                 logger.warning("Split successful but couldn't identify new fulfillment order ID")
                 return None, "Split successful but couldn't identify new fulfillment order ID"
-        else:
-            logger.warning("No splits returned from API")
-            return None, "No splits returned from API"
+            
+            logger.debug("Successfully split items, new fulfillment order ID: %s", new_id)
+            new_orders.append((new_id, new_status))
+        
+        return new_orders, None
     except (KeyError, IndexError, TypeError) as e:
         logger.error(f"Error parsing split response: {str(e)}")
         return None, f"Error parsing split response: {str(e)}"
 
-def add_tag_to_order(order_id, tag):
-    """Add a tag to an order using the GraphQL API."""
+def add_tags_to_order(order_id, tags):
+    """Add one or more tags to an order with a single GraphQL tagsAdd mutation."""
     # Check if order_id is None or empty
     if not order_id:
-        logger.warning(f"Cannot add tag '{tag}' because order_id is None or empty")
+        logger.warning(f"Cannot add tags {tags} because order_id is None or empty")
         return False
         
     # Ensure order_id is in the correct format
-    if not order_id.startswith('gid://'):
-        order_id = f"gid://shopify/Order/{order_id}"
+    if not order_id.startswith("gid://"):
+        order_id = _ORDER_GID_PREFIX + order_id
     
     # Create the GraphQL mutation
     mutation = {
-        "query": """
-        mutation addTags($id: ID!, $tags: [String!]!) {
-          tagsAdd(id: $id, tags: $tags) {
-            node {
-              id
-            }
-            userErrors {
-              message
-            }
-          }
-        }
-        """,
+        "query": TAGS_ADD_MUTATION,
         "variables": {
             "id": order_id,
-            "tags": [tag]
+            "tags": tags
         }
     }
     
-    logger.info(f"Adding tag '{tag}' to order {order_id}")
+    logger.info(f"Adding tags {tags} to order {order_id}")
     result = send_request_with_retry(mutation)
     
     # Check for errors
     if not result:
-        logger.error(f"Failed to add tag to order {order_id}")
+        logger.error(f"Failed to add tags to order {order_id}")
         return False
     
     if 'errors' in result:
-        logger.error(f"GraphQL errors when adding tag: {json.dumps(result['errors'])}")
+        logger.error(f"GraphQL errors when adding tags: {json_dumps(result['errors'])}")
         return False
     
     # Check for user errors
@@ -448,12 +629,13 @@ def add_tag_to_order(order_id, tag):
         logger.error(f"Could not check for user errors in tagsAdd response")
     
     if user_errors:
-        logger.error(f"User errors when adding tag: {json.dumps(user_errors)}")
+        logger.error(f"User errors when adding tags: {json_dumps(user_errors)}")
         return False
     
-    logger.info(f"Successfully added tag '{tag}' to order {order_id}")
+    logger.info(f"Successfully added tags {tags} to order {order_id}")
     return True
 
+@functools.lru_cache(maxsize=64)
 def get_location_tag(location):
     """
     Get the appropriate tag for a given location based on the custom rules.
@@ -467,7 +649,30 @@ def get_location_tag(location):
         # Default format for other locations
         return f"{location}Fulfillment"
 
-    
+
+def to_split_line_items(items):
+    """Build the fulfillmentOrderLineItems payload (only id and quantity) for a split."""
+    return [{"id": item.id, "quantity": item.quantity} for item in items]
+
+def add_pending_tags(order_id, pending_tags, results, submitted=None):
+    """
+    Add all tags collected while processing the decision tree in one mutation
+    and record them in the results. submitted is an optional (future, tags) pair for
+    tags already being added in the background; it is awaited and, if that mutation
+    succeeded, those tags are not sent again.
+    """
+    # The same tag can be collected more than once (e.g. daktrimFulfillment)
+    tags = list(dict.fromkeys(pending_tags))
+    if submitted:
+        future, submitted_tags = submitted
+        # A failed background mutation leaves its tags in the final one, which retries them
+        if future.result():
+            results['tags_added'].extend(submitted_tags)
+            tags = [tag for tag in tags if tag not in submitted_tags]
+    if order_id and tags and add_tags_to_order(order_id, tags):
+        results['tags_added'].extend(tags)
+    return results
+
 def process_fulfillment_according_to_decision_tree(order_id, fulfillment_order_id, categories):
     """
     Process the fulfillment order according to the decision tree logic.
@@ -479,344 +684,184 @@ def process_fulfillment_according_to_decision_tree(order_id, fulfillment_order_i
         'error': None
     }
     
+    # Tags are collected here and added in a single mutation once processing is done
+    pending_tags = []
+    
+    n_rooftopshop = (len(categories.length_rooftopshop) +
+                     len(categories.non_length_rooftopshop) +
+                     len(categories.daktrim_koppelstukje_rooftopshop))
+    n_external = len(categories.length_external) + len(categories.non_length_external)
+    
+    # Everything is at Rooftopshop and there are no length items to separate: nothing to split or tag
+    if n_external == 0 and not categories.summary.has_length_items:
+        logger.info("All items are at Rooftopshop Magazijn and there are no length items - nothing to split")
+        # Same as the 'No' branch: koppelstukje items count as regular non-length items
+        categories.non_length_rooftopshop.extend(categories.daktrim_koppelstukje_rooftopshop)
+        return results
+    
     # ENHANCEMENT: Check if we need to add tags regardless of splitting capability
     # For daktrim fulfillment - when all length items are at Rooftopshop
-    if categories['summary']['has_length_items'] and len(categories['length_external']) == 0:
+    if categories.summary.has_length_items and len(categories.length_external) == 0:
         logger.info("Order has length items at Rooftopshop - adding daktrimFulfillment tag")
-        if order_id and add_tag_to_order(order_id, "daktrimFulfillment"):
-            results['tags_added'].append("daktrimFulfillment")
+        pending_tags.append("daktrimFulfillment")
     
     # For external fulfillment - when all items are at a specific external location
-    if len(categories['length_external']) > 0 or len(categories['non_length_external']) > 0:
-        # Get unique external locations
-        external_locations = set()
-        for item in categories['length_external'] + categories['non_length_external']:
-            for location in item.get('locations', []):
-                if location != "Rooftopshop Magazijn":
-                    external_locations.add(location)
+    if n_external > 0:
+        # Unique external locations, already collected by categorize_items
+        external_locations = categories.summary.external_locations
         
         # If there's exactly one external location and all items are external
-        if len(external_locations) == 1 and (len(categories['length_rooftopshop']) + 
-                                           len(categories['non_length_rooftopshop']) +
-                                           len(categories['daktrim_koppelstukje_rooftopshop'])) == 0:
+        if len(external_locations) == 1 and n_rooftopshop == 0:
             location = next(iter(external_locations))
             tag = get_location_tag(location)
             logger.info(f"All items are from external location {location} - adding {tag} tag")
-            if order_id and add_tag_to_order(order_id, tag):
-                results['tags_added'].append(tag)
+            pending_tags.append(tag)
+            
+            # When every item ships from that location there is nothing to split off
+            if all(item.available_locations for item in chain(categories.length_external,
+                                                              categories.non_length_external)):
+                logger.info(f"All items ship from {location} - no split needed")
+                return add_pending_tags(order_id, pending_tags, results)
+
+    # Splits are planned up front from the categorized items (location data doesn't change
+    # between splits) and submitted together in a single fulfillmentOrderSplit mutation
+    planned_splits = []
 
     # First decision: Are there any length items?
-    if categories['summary']['has_length_items']:
+    if categories.summary.has_length_items:
         logger.info("Order has length items - following 'Yes' branch of decision tree")
         
-        # We'll need to track which line items remain in the fulfillment order after each split
-        fulfillment_details = None
-        
-        # Process one category at a time
         # 1. First handle all length items in Rooftopshop along with daktrim_koppelstukje
-        if categories['length_rooftopshop']:
-            logger.info(f"Processing {len(categories['length_rooftopshop'])} length items at Rooftopshop Magazijn")
+        if categories.length_rooftopshop:
+            logger.info(f"Processing {len(categories.length_rooftopshop)} length items at Rooftopshop Magazijn")
 
-            # Combine length items and daktrim_koppelstukje items
-            combined_items = []
-
-            # Add length items
-            for item in categories['length_rooftopshop']:
-                combined_items.append({
-                    "id": item["id"],
-                    "quantity": item["quantity"]
-                })
-            
             # Add daktrim koppelstukje items if any - these should be split together with length items
-            if categories['daktrim_koppelstukje_rooftopshop']:
-                logger.info(f"Including {len(categories['daktrim_koppelstukje_rooftopshop'])} daktrim koppelstukje items with length items")
-                for item in categories['daktrim_koppelstukje_rooftopshop']:
-                    combined_items.append({
-                        "id": item["id"],
-                        "quantity": item["quantity"]
-                    })
+            if categories.daktrim_koppelstukje_rooftopshop:
+                logger.info(f"Including {len(categories.daktrim_koppelstukje_rooftopshop)} daktrim koppelstukje items with length items")
+            
+            # Combine length items and daktrim_koppelstukje items
+            combined_items = to_split_line_items(chain(categories.length_rooftopshop,
+                                                       categories.daktrim_koppelstukje_rooftopshop))
             
             # Log the actual data we're sending to the API
-            logger.info(f"Sending items to split API: {json.dumps(combined_items)}")
-
-            new_id, status = split_fulfillment_order(fulfillment_order_id, combined_items)
+            logger.debug("Sending items to split API: %s", combined_items)
 
-            if new_id:
-                results['splits'].append({
-                    'type': 'length_rooftopshop_with_koppelstukje',
-                    'fulfillment_order_id': new_id,
-                    'status': status,
-                    'items': combined_items
-                })
-                
-                # Add daktrimFulfillment tag
-                if order_id and add_tag_to_order(order_id, "daktrimFulfillment"):
-                    results['tags_added'].append("daktrimFulfillment")
-                
-                # Add delay after tag operation to allow Shopify to process
-                time.sleep(2)
-                
-                # Get updated fulfillment details after the split
-                fulfillment_details = get_fulfillment_order_details(fulfillment_order_id)
-                if not fulfillment_details:
-                    results['success'] = False
-                    results['error'] = "Failed to get updated fulfillment order details after splitting length items at Rooftopshop"
-                    return results
-            else:
-                results['success'] = False
-                results['error'] = f"Failed to split length items at Rooftopshop: {status}"
-                return results
+            planned_splits.append({
+                'type': 'length_rooftopshop_with_koppelstukje',
+                'items': combined_items
+            })
         
         # 2. Now handle external items - combine length and non-length by location
-        if not categories['summary']['all_items_at_rooftopshop']:
+        if not categories.summary.all_items_at_rooftopshop:
             logger.info("Processing external items by location (both length and non-length together)")
             
-            # If we don't have updated fulfillment details yet, get them now
-            if not fulfillment_details:
-                fulfillment_details = get_fulfillment_order_details(fulfillment_order_id)
-                if not fulfillment_details:
-                    results['success'] = False
-                    results['error'] = "Failed to get fulfillment order details before splitting external items"
-                    return results
-            
-            # Create a map of remaining line items to check against
-            remaining_line_items = {item['fulfillment_order_line_item_id']: item for item in fulfillment_details['line_items']}
-            logger.info(f"Remaining items before external processing: {len(remaining_line_items)}")
-            
             # Group by location - combining both length and non-length external items
-            location_groups = {}
+            location_groups = defaultdict(list)
             
-            # Process length external items
-            for item in categories['length_external']:
-                if item['id'] in remaining_line_items:
-                    # Get the locations from the remaining item
-                    locations = remaining_line_items[item['id']]['available_locations']
-                    if not isinstance(locations, list):
-                        locations = [locations] if locations else []
-                    
-                    # Assign to first non-Rooftopshop location
-                    assigned = False
-                    for location in locations:
-                        if location != "Rooftopshop Magazijn":
-                            if location not in location_groups:
-                                location_groups[location] = []
-                            
-                            location_groups[location].append({
-                                "id": item['id'],
-                                "quantity": item['quantity']
-                            })
-                            assigned = True
-                            break
-                    
-                    # If no valid location found, add to "unknown" group
-                    if not assigned and locations:
-                        if "unknown" not in location_groups:
-                            location_groups["unknown"] = []
-                        
-                        location_groups["unknown"].append({
-                            "id": item['id'],
-                            "quantity": item['quantity']
-                        })
-            
-            # Process non-length external items and add to the same location groups
-            for item in categories['non_length_external']:
-                if item['id'] in remaining_line_items:
-                    # Get the locations from the remaining item
-                    locations = remaining_line_items[item['id']]['available_locations']
-                    if not isinstance(locations, list):
-                        locations = [locations] if locations else []
-                    
-                    # Assign to first non-Rooftopshop location
-                    assigned = False
-                    for location in locations:
-                        if location != "Rooftopshop Magazijn":
-                            if location not in location_groups:
-                                location_groups[location] = []
-                            
-                            location_groups[location].append({
-                                "id": item['id'],
-                                "quantity": item['quantity']
-                            })
-                            assigned = True
-                            break
-                    
-                    # If no valid location found, add to "unknown" group
-                    if not assigned and locations:
-                        if "unknown" not in location_groups:
-                            location_groups["unknown"] = []
-                        
-                        location_groups["unknown"].append({
-                            "id": item['id'],
-                            "quantity": item['quantity']
-                        })
+            for item in chain(categories.length_external, categories.non_length_external):
+                if item.target_location:
+                    location_groups[item.target_location].append(item)
             
             # Log the location groups before processing
-            logger.info(f"Location groups created: {json.dumps({loc: len(items) for loc, items in location_groups.items()})}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Location groups created: %s", {loc: len(items) for loc, items in location_groups.items()})
             
-            # Process each location group
-            for location, items in location_groups.items():
-                if not items:
-                    continue
-                
-                logger.info(f"Splitting {len(items)} items (both length and non-length) for external location: {location}")
+            # Plan a split for each location group
+            for location, location_items in location_groups.items():
+                items = to_split_line_items(location_items)
+                logger.debug("Splitting %d items (both length and non-length) for external location: %s", len(items), location)
                 
                 # Log the actual data we're sending to the API
-                logger.info(f"Sending items to split API: {json.dumps(items)}")
+                logger.debug("Sending items to split API: %s", items)
                 
-                new_id, status = split_fulfillment_order(fulfillment_order_id, items)
-                
-                # Add substantial delay after split operation to ensure Shopify has time to process
-                time.sleep(3)
-                
-                if new_id:
-                    results['splits'].append({
-                        'type': f'external_{location}',
-                        'fulfillment_order_id': new_id,
-                        'status': status,
-                        'items': items,
-                        'location': location
-                    })
-                    
-                    # Add location tag with the custom format
-                    tag = get_location_tag(location)
-                    if order_id and add_tag_to_order(order_id, tag):
-                        results['tags_added'].append(tag)
-                    
-                    # Add delay after tag operation
-                    time.sleep(1)
-                    
-                    # Update fulfillment details after each split
-                    logger.info(f"Getting updated fulfillment details after splitting items at {location}")
-                    fulfillment_details = get_fulfillment_order_details(fulfillment_order_id)
-                    if not fulfillment_details:
-                        results['success'] = False
-                        results['error'] = f"Failed to get updated fulfillment order details after splitting items at {location}"
-                        return results
-                    
-                    # Update remaining line items map
-                    remaining_line_items = {item['fulfillment_order_line_item_id']: item for item in fulfillment_details['line_items']}
-                    logger.info(f"Remaining items after {location} split: {len(remaining_line_items)}")
-                else:
-                    logger.error(f"Failed to split items for {location}: {status}")
-                    results['success'] = False
-                    results['error'] = f"Failed to split items for {location}: {status}"
-                    return results
+                planned_splits.append({
+                    'type': f'external_{location}',
+                    'items': items,
+                    'location': location
+                })
     else:
         logger.info("Order has no length items - following 'No' branch of decision tree")
 
         # When there are no length items in the order, treat daktrim_koppelstukje items as regular non-length items
-        if categories['daktrim_koppelstukje_rooftopshop']:
-            logger.info(f"Adding {len(categories['daktrim_koppelstukje_rooftopshop'])} daktrim koppelstukje items to non-length items category")
-            for item in categories['daktrim_koppelstukje_rooftopshop']:
-                categories['non_length_rooftopshop'].append(item)
+        if categories.daktrim_koppelstukje_rooftopshop:
+            logger.info(f"Adding {len(categories.daktrim_koppelstukje_rooftopshop)} daktrim koppelstukje items to non-length items category")
+            for item in categories.daktrim_koppelstukje_rooftopshop:
+                categories.non_length_rooftopshop.append(item)
         
         # Decision: Are all non-length products available at Rooftopshop Magazijn?
-        if categories['summary']['all_non_length_at_rooftopshop']:
+        if categories.summary.all_non_length_at_rooftopshop:
             logger.info("All non-length items are at Rooftopshop Magazijn - ready for picking")
             # Nothing to do, everything is at Rooftopshop and ready for picking
         else:
             logger.info("Not all non-length items are at Rooftopshop - splitting by location")
             
-            # Get updated fulfillment details
-            fulfillment_details = get_fulfillment_order_details(fulfillment_order_id)
-            if not fulfillment_details:
-                results['success'] = False
-                results['error'] = "Failed to get fulfillment order details before splitting external non-length items"
-                return results
-            
-            # Create a map of remaining line items
-            remaining_line_items = {item['fulfillment_order_line_item_id']: item for item in fulfillment_details['line_items']}
-            logger.info(f"Remaining items before non-length external processing: {len(remaining_line_items)}")
-            
             # Group by location
-            location_groups = {}
+            location_groups = defaultdict(list)
             
-            # Only process items that are still in the current fulfillment order
-            for item in categories['non_length_external']:
-                if item['id'] in remaining_line_items:
-                    # Get the locations from the remaining item - ensure it's a list
-                    locations = remaining_line_items[item['id']]['available_locations']
-                    if not isinstance(locations, list):
-                        # Convert to list if it's not already
-                        locations = [locations] if locations else []
-                    
-                    # Assign to first non-Rooftopshop location
-                    assigned = False
-                    for location in locations:
-                        if location != "Rooftopshop Magazijn":
-                            if location not in location_groups:
-                                location_groups[location] = []
-                            
-                            location_groups[location].append({
-                                "id": item['id'],
-                                "quantity": item['quantity']
-                            })
-                            assigned = True
-                            break
-                    
-                    # If no valid location found, add to "unknown" group
-                    if not assigned and locations:
-                        if "unknown" not in location_groups:
-                            location_groups["unknown"] = []
-                        
-                        location_groups["unknown"].append({
-                            "id": item['id'],
-                            "quantity": item['quantity']
-                        })
+            for item in categories.non_length_external:
+                if item.target_location:
+                    location_groups[item.target_location].append(item)
             
             # Log the location groups before processing
-            logger.info(f"Non-length location groups created: {json.dumps({loc: len(items) for loc, items in location_groups.items()})}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Non-length location groups created: %s", {loc: len(items) for loc, items in location_groups.items()})
             
-            # Process each location group
-            for location, items in location_groups.items():
-                if not items:
-                    continue
-                
-                logger.info(f"Splitting {len(items)} non-length items for external location: {location}")
+            # Plan a split for each location group
+            for location, location_items in location_groups.items():
+                items = to_split_line_items(location_items)
+                logger.debug("Splitting %d non-length items for external location: %s", len(items), location)
                 
                 # Log the items we're about to split
-                logger.info(f"Sending items to split API: {json.dumps(items)}")
+                logger.debug("Sending items to split API: %s", items)
                 
-                new_id, status = split_fulfillment_order(fulfillment_order_id, items)
-                
-                # Add substantial delay after split operation
-                time.sleep(3)
-                
-                if new_id:
-                    results['splits'].append({
-                        'type': f'external_{location}',
-                        'fulfillment_order_id': new_id,
-                        'status': status,
-                        'items': items,
-                        'location': location
-                    })
-                    
-                    # Add location tag with custom naming pattern
-                    tag = get_location_tag(location)
-                    if order_id and add_tag_to_order(order_id, tag):
-                        results['tags_added'].append(tag)
-                    
-                    # Add delay after tag operation
-                    time.sleep(1)
-                    
-                    # Update fulfillment details after each split
-                    logger.info(f"Getting updated fulfillment details after splitting non-length items at {location}")
-                    fulfillment_details = get_fulfillment_order_details(fulfillment_order_id)
-                    if not fulfillment_details:
-                        results['success'] = False
-                        results['error'] = f"Failed to get updated fulfillment order details after splitting non-length items at {location}"
-                        return results
-                    
-                    # Update remaining line items map
-                    remaining_line_items = {item['fulfillment_order_line_item_id']: item for item in fulfillment_details['line_items']}
-                    logger.info(f"Remaining items after {location} split: {len(remaining_line_items)}")
-                else:
-                    logger.error(f"Failed to split non-length items for {location}: {status}")
-                    results['success'] = False
-                    results['error'] = f"Failed to split non-length items for {location}: {status}"
-                    break
+                planned_splits.append({
+                    'type': f'external_{location}',
+                    'items': items,
+                    'location': location
+                })
     
-    return results
+    if not planned_splits:
+        return add_pending_tags(order_id, pending_tags, results)
+    
+    # Tags collected so far don't depend on the outcome of the split, so add them
+    # in the background while the split mutation is in flight
+    submitted = None
+    if order_id and pending_tags:
+        submitted_tags = list(dict.fromkeys(pending_tags))
+        submitted = (EXECUTOR.submit(add_tags_to_order, order_id, submitted_tags), submitted_tags)
+    
+    # Submit every planned split in one mutation
+    logger.info(f"Submitting {len(planned_splits)} splits in a single mutation")
+    new_orders, error = split_fulfillment_order([
+        {"fulfillmentOrderId": fulfillment_order_id, "fulfillmentOrderLineItems": split['items']}
+        for split in planned_splits
+    ])
+    
+    if new_orders is None:
+        logger.error(f"Failed to split fulfillment order: {error}")
+        results['success'] = False
+        results['error'] = f"Failed to split fulfillment order: {error}"
+        return add_pending_tags(order_id, pending_tags, results, submitted)
+    
+    for split, (new_id, status) in zip(planned_splits, new_orders):
+        split_result = {
+            'type': split['type'],
+            'fulfillment_order_id': new_id,
+            'status': status,
+            'items': split['items']
+        }
+        if 'location' in split:
+            # Add location tag with the custom format
+            split_result['location'] = split['location']
+            pending_tags.append(get_location_tag(split['location']))
+        else:
+            # Add daktrimFulfillment tag
+            pending_tags.append("daktrimFulfillment")
+        results['splits'].append(split_result)
+    
+    logger.info("Split fulfillment order into %d new fulfillment orders: %s",
+                len(new_orders), [new_id for new_id, _ in new_orders])
+    return add_pending_tags(order_id, pending_tags, results, submitted)
 
 def lambda_handler(event, context):
     """
@@ -831,49 +876,37 @@ def lambda_handler(event, context):
             if 'body' in event:
                 # API Gateway format
                 if isinstance(event['body'], str):
-                    body = json.loads(event['body'])
+                    body = json_loads(event['body'])
                 else:
                     body = event['body']
             else:
                 # Direct invocation
                 body = event
         
-        if not body:
+        if not body or not isinstance(body, dict):
             logger.error("No request body found")
             return {
                 'statusCode': 400,
-                'body': json.dumps({'error': 'No request body found'})
+                'body': json_dumps({'error': 'No request body found'})
             }
         
         # Extract OrderId and FulfillmentOrderId from the request
-        order_id = None
-        fulfillment_order_id = None
-        
-        if 'OrderId' in body:
-            order_id = body['OrderId']
-        elif 'orderId' in body:
-            order_id = body['orderId']
-        
-        if 'FulfillmentOrderId' in body:
-            fulfillment_order_id = body['FulfillmentOrderId']
-        elif 'fulfillmentOrderId' in body:
-            fulfillment_order_id = body['fulfillmentOrderId']
-        elif 'id' in body:
-            fulfillment_order_id = body['id']
+        order_id = body.get('OrderId') or body.get('orderId')
+        fulfillment_order_id = body.get('FulfillmentOrderId') or body.get('fulfillmentOrderId') or body.get('id')
         
         if not fulfillment_order_id:
             logger.error("Missing FulfillmentOrderId in the request")
             return {
                 'statusCode': 400,
-                'body': json.dumps({'error': 'FulfillmentOrderId is required'})
+                'body': json_dumps({'error': 'FulfillmentOrderId is required'})
             }
         
         # Log both IDs
         logger.info(f"Processing order: {order_id if order_id else 'None'}, fulfillment order: {fulfillment_order_id}")
         
         # Ensure the fulfillment order ID is in the correct format
-        if not fulfillment_order_id.startswith('gid://'):
-            fulfillment_order_id = f"gid://shopify/FulfillmentOrder/{fulfillment_order_id}"
+        if not fulfillment_order_id.startswith("gid://"):
+            fulfillment_order_id = _GID_PREFIX + fulfillment_order_id
         
         # 1. Get fulfillment order details with line items and metafields
         order_details = get_fulfillment_order_details(fulfillment_order_id)
@@ -882,7 +915,7 @@ def lambda_handler(event, context):
             logger.error(f"Failed to get details for fulfillment order {fulfillment_order_id}")
             return {
                 'statusCode': 500,
-                'body': json.dumps({
+                'body': json_dumps({
                     'error': f'Failed to get details for fulfillment order {fulfillment_order_id}'
                 })
             }
@@ -892,7 +925,7 @@ def lambda_handler(event, context):
             logger.info(f"Fulfillment order {fulfillment_order_id} has no line items to process")
             return {
                 'statusCode': 200,
-                'body': json.dumps({
+                'body': json_dumps({
                     'success': True,
                     'message': f"Fulfillment order {fulfillment_order_id} has no line items to process",
                     'fulfillment_order_id': fulfillment_order_id,
@@ -912,32 +945,40 @@ def lambda_handler(event, context):
         )
         
         # 4. Prepare response
+        # (counted after processing: the 'No' branch moves daktrim koppelstukje items into non_length_rooftopshop)
+        n_length_rooftopshop = len(categories.length_rooftopshop)
+        n_length_external = len(categories.length_external)
+        n_non_length_rooftopshop = len(categories.non_length_rooftopshop)
+        n_non_length_external = len(categories.non_length_external)
+        success = results['success']
+        error = results['error']
+        
         response_data = {
-            'success': results['success'],
+            'success': success,
             'fulfillment_order_id': fulfillment_order_id,
             'order_id': order_id,
             'splits': results['splits'],
             'tags_added': results['tags_added'],
             'item_categories': {
-                'length_items_count': len(categories['length_rooftopshop']) + len(categories['length_external']),
-                'non_length_items_count': len(categories['non_length_rooftopshop']) + len(categories['non_length_external']),
-                'items_at_rooftopshop': len(categories['length_rooftopshop']) + len(categories['non_length_rooftopshop']),
-                'items_at_external': len(categories['length_external']) + len(categories['non_length_external'])
+                'length_items_count': n_length_rooftopshop + n_length_external,
+                'non_length_items_count': n_non_length_rooftopshop + n_non_length_external,
+                'items_at_rooftopshop': n_length_rooftopshop + n_non_length_rooftopshop,
+                'items_at_external': n_length_external + n_non_length_external
             }
         }
         
-        if results['error']:
-            response_data['error'] = results['error']
+        if error:
+            response_data['error'] = error
         
         # Format the response based on the invocation type
         if 'httpMethod' in event:
             # API Gateway response
             return {
-                'statusCode': 200 if results['success'] else 500,
+                'statusCode': 200 if success else 500,
                 'headers': {
                     'Content-Type': 'application/json'
                 },
-                'body': json.dumps(response_data)
+                'body': json_dumps(response_data)
             }
         else:
             # Direct invocation response
@@ -945,24 +986,27 @@ def lambda_handler(event, context):
     
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
+        tb = traceback.format_exc()
+        logger.error(tb)
         
         # Format error response based on invocation type
         if 'httpMethod' in event:
+            error_data = {
+                'success': False,
+                'error': f'Unexpected error: {str(e)}'
+            }
+            if DEBUG:
+                error_data['traceback'] = tb
             return {
                 'statusCode': 500,
                 'headers': {
                     'Content-Type': 'application/json'
                 },
-                'body': json.dumps({
-                    'success': False,
-                    'error': f'Unexpected error: {str(e)}'
-                })
+                'body': json_dumps(error_data)
             }
         else:
             return {
                 'success': False,
                 'error': f'Unexpected error: {str(e)}',
-                'traceback': traceback.format_exc()
+                'traceback': tb
             }